@@ -1,77 +1,56 @@
 import os
+import argparse
+import asyncio
+import csv
+import hashlib
+import logging
+import sqlite3
 import pandas as pd
-import json
-import subprocess
+import orjson
 import re
+from concurrent.futures import ProcessPoolExecutor
+from ollama import AsyncClient
+from pydantic import BaseModel, ValidationError
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_HOST = "http://localhost:11434"
+MODEL_NAME = "llama3.2:3b-instruct-q4_K_M"
+# Keep the model loaded between requests
+KEEP_ALIVE = "30m"
+# Cap context and output length for the small JSON responses; a low temperature keeps the JSON well-formed
+OLLAMA_OPTIONS = {"num_ctx": 2048, "num_predict": 1024, "temperature": 0.1}
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "llmradiology", "responses.sqlite")
+# Keep in step with the server's OLLAMA_NUM_PARALLEL so each batch fills every slot
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
+# Below this many reports, validating inline is cheaper than starting worker processes
+PROCESS_POOL_MIN_ROWS = 10000
+
+# A report skips the LLM only if it matches _BENIGN and, once the negated phrases are removed,
+# nothing in it matches _SUSPICIOUS; any specimen with a finding sends the whole report to the LLM
+_BENIGN = re.compile(r"\b(?:benign|negative for (?:malignancy|carcinoma|tumor)|no evidence of malign)", re.I)
+_NEGATED = re.compile(r"\b(?:negative for (?:malignancy|carcinoma|tumor)|no evidence of malign\w*)", re.I)
+_SUSPICIOUS = re.compile(r"carcinoma|malignan|cancer|tumou?r|gleason|atyp|suspicious|\b(?:HG)?PIN\b|ASAP|inflam|prostatitis", re.I)
+# LLM-bound reports that mention benign tissue but no carcinoma or Gleason grade have every specimen marked benign
+_CARCINOMA = re.compile(r"carcinoma|malignan|cancer|tumou?r|gleason", re.I)
+
+# Header of the output file; specimen_row writes the fields in the same order
+OUTPUT_COLUMNS = ["StudyID", "Specimen", "GS", "GP", "#C", "%Spec", "HGPIN", "ASAP", "ATYP", "INF", "ADC", "Comment"]
+
+# One async client keeps the connection to Ollama alive and lets requests overlap
+client = AsyncClient(host=OLLAMA_HOST)
+
+# In-memory and on-disk response caches; _cache_db stays None until open_cache is called,
+# and _cache_reads is False under --no-cache so responses are refreshed but not reused
+_response_memo = {}
+_cache_db = None
+_cache_reads = True
+
+# Fixed instructions sent as the system prompt. Keeping them identical for every report and placing
+# the report last lets Ollama reuse the cached prefix instead of re-processing it on each request.
+SYSTEM_PREFIX = """
+You are a data scientist tasked with extracting clinical data from a pathology report. The goal is to create a structured clinical dataset in the form of a JSON object. Please extract the number of biopsy specimens mentioned in the report as "number_of_specimens". These usually have a number or letter that separate each specimen. Then extract the following details from the provided pathology report for each specimen:
 
-def fix_malformed_json(json_str):
-    """
-    Attempts to fix common JSON format issues:
-    - Adds missing commas before new keys
-    - Closes unclosed brackets
-    - Removes invalid characters
-    """
-    try:
-        json_str = json_str.strip()
-
-        # Ensure brackets are balanced
-        if json_str.count("{") > json_str.count("}"):
-            json_str += "}"
-        if json_str.count("[") > json_str.count("]"):
-            json_str += "]"
-
-        # Replace common errors (missing commas)
-        json_str = re.sub(r'("\w+":\s?"[^"]+)"\s*("\w+":)', r'\1,\2', json_str)
-
-        return json.loads(json_str)  # Try parsing the fixed JSON
-    except json.JSONDecodeError as e:
-        print(f"Error fixing JSON: {e}\nRaw output:\n{json_str}")
-        return None
-
-def get_number_of_specimens(report_text):
-    """
-    Sends a pathology report to the local LLM via Ollama and extracts the number of specimens.
-    """
-    prompt = f"""
-You are a data scientist tasked with extracting clinical data from a pathology report. Please extract the number of biopsy specimens mentioned in the report. These usually have a number or letter that separate each specimen. Respond with just the number.
-
-### Pathology Report:
-{report_text}
-"""
-
-    model_name = "llama3.2"
-
-    try:
-        result = subprocess.run(
-            ["ollama", "run", model_name],
-            input=prompt,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            check=True
-        )
-
-        content = result.stdout.strip()
-        print("\nRaw LLM Output for number of specimens:\n", content)
-
-        try:
-            number_of_specimens = int(re.search(r'\d+', content).group())
-            return number_of_specimens
-        except (ValueError, AttributeError) as e:
-            print(f"Error parsing number of specimens: {e}\nRaw Output:\n{content}")
-            return 0
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-        return 0
-
-def extract_info_from_report(report_text, accession_number, number_of_specimens, line_number):
-    """
-    Sends a pathology report to the local LLM via Ollama and extracts structured data for each specimen.
-    """
-    prompt = f"""
-You are a data scientist tasked with extracting clinical data from a pathology report. The goal is to create a structured clinical dataset in the form of a JSON object. Please extract the following details from the provided pathology report for each of the {number_of_specimens} specimens:
-
-- "study_id": Use the provided accession number "{accession_number}". If no study_id is present, add "subject_{line_number}".
 - "specimen_name": Specimen type (e.g., "Right Apex Biopsy"). Remove commas and rearrange the words as necessary to get the order to match the example. Ignore specimens from other tissues and diagnostic information. These usually start with a number or letter. 
 - "gleason_score": Numeric value from 6 to 10. If missing but "gleason_pattern" is present, sum the two patterns. If the specimen is benign, set to "benign".
 - "gleason_pattern": Score between 1-5 or "Grade Group". If benign, set to "benign".
@@ -85,86 +64,168 @@ You are a data scientist tasked with extracting clinical data from a pathology r
   - "ADC": 0 (absent) or 1 (present) - adenocarcinoma described but no GS given
 - "comment": Unique findings not included elsewhere. If benign, include "benign" in comments.
 
-Ensure the response is a valid JSON object with a "specimens" list, where each entry follows the specified format.
-
-### Pathology Report:
-{report_text}
+Ensure the response is a valid JSON object with an integer "number_of_specimens" and a "specimens" list, where each entry follows the specified format.
 """
 
-    model_name = "llama3.2"
+# Response schema; Ollama constrains decoding to it and the reply is validated against it
+class Features(BaseModel):
+    HGPIN: int
+    ASAP: int
+    ATYP: int
+    INF: int
+    ADC: int
+
+class Specimen(BaseModel):
+    specimen_name: str
+    gleason_score: str
+    gleason_pattern: str
+    num_cores: str
+    percent_specimen: str
+    features: Features
+    comment: str
+
+class ExtractionResponse(BaseModel):
+    number_of_specimens: int
+    specimens: list[Specimen]
+
+RESPONSE_SCHEMA = ExtractionResponse.model_json_schema()
+
+def open_cache(path=CACHE_PATH, reads=True):
+    """
+    Opens the on-disk response cache so reruns on unchanged reports skip the LLM.
+    With reads=False every report is sent to the LLM and the cache only receives the new responses.
+    """
+    global _cache_db, _cache_reads
+    _cache_reads = reads
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _cache_db = sqlite3.connect(path)
+    _cache_db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT NOT NULL)")
 
-    try:
-        result = subprocess.run(
-            ["ollama", "run", model_name],
-            input=prompt,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            check=True
-        )
+def load_cached_response(key):
+    """
+    Returns the cached LLM response for the key, or None on a miss or when cache reads are disabled.
+    """
+    if _cache_db is None or not _cache_reads:
+        return None
+    if key in _response_memo:
+        return _response_memo[key]
+    row = _cache_db.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+    if row is not None:
+        _response_memo[key] = row[0]
+        return row[0]
+    return None
+
+def save_cached_response(key, content):
+    """
+    Stores a validated LLM response in the memory and disk caches.
+    """
+    if _cache_db is None:
+        return
+    _response_memo[key] = content
+    with _cache_db:
+        _cache_db.execute("INSERT OR REPLACE INTO responses (key, content) VALUES (?, ?)", (key, content))
 
-        content = result.stdout.strip()
-        print("\nRaw LLM Output for specimen details:\n", content)
+def cache_key(prompt, system, schema):
+    """
+    Hashes everything that shapes a response, so editing the schema or the options misses old entries.
+    """
+    settings = orjson.dumps({"schema": schema, "options": OLLAMA_OPTIONS}, option=orjson.OPT_SORT_KEYS).decode()
+    return hashlib.sha256((MODEL_NAME + "\0" + settings + "\0" + system + "\0" + prompt).encode()).hexdigest()
 
-        try:
-            json_match = re.search(r"\{.*\}", content, re.DOTALL)
-            if json_match:
-                json_text = json_match.group(0)
-                json_text = re.sub(r",\s*([\]}])", r"\1", json_text)
-                data = json.loads(json_text)
-
-                if "specimens" in data and isinstance(data["specimens"], list):
-                    return data["specimens"]
-                else:
-                    print("Error: JSON output did not contain expected 'specimens' list.")
-                    return None
-            else:
-                print("Error: No valid JSON found.")
-                return None
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON: {e}\nRaw Output:\n{content}")
-            return None
+async def run_ollama(prompt, system, schema):
+    """
+    Sends a prompt to the local Ollama server and returns the raw response text, constrained
+    to the given JSON schema, with the cache key to save it under once it has been validated.
+    The key is None when the response already came from the cache.
+    """
+    key = cache_key(prompt, system, schema)
+    content = load_cached_response(key)
+    if content is not None:
+        return content, None
+
+    response = await client.generate(
+        model=MODEL_NAME,
+        prompt=prompt,
+        system=system,
+        format=schema,
+        options=OLLAMA_OPTIONS,
+        keep_alive=KEEP_ALIVE
+    )
+    content = response["response"].strip()
+    return content, key
+
+async def fetch_response(report_text):
+    """
+    Sends a pathology report to the local LLM via Ollama and returns the raw JSON text
+    for all of its specimens and its cache key, or (None, None) if the request fails.
+    """
+    prompt = f"\n\n### Pathology Report:\n{report_text}\n"
+
+    try:
+        content, key = await run_ollama(prompt, SYSTEM_PREFIX, RESPONSE_SCHEMA)
     except Exception as e:
         print(f"Unexpected error: {e}")
-        return None
+        return None, None
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Raw LLM Output for specimen details: %s", content)
+    return content, key
+
+def specimen_row(specimen):
+    """
+    Flattens one specimen into an output row, with each feature in its own column.
+    """
+    features = specimen["features"]
+    return [
+        specimen["study_id"],
+        specimen["specimen_name"],
+        specimen["gleason_score"],
+        specimen["gleason_pattern"],
+        specimen["num_cores"],
+        specimen["percent_specimen"],
+        features["HGPIN"],
+        features["ASAP"],
+        features["ATYP"],
+        features["INF"],
+        features["ADC"],
+        specimen["comment"]
+    ]
+
+def benign_template(accession_number, line_number):
+    """
+    Returns the fixed output for a benign report without querying the LLM.
+    """
+    return [{
+        "study_id": accession_number if accession_number else f"subject_{line_number}",
+        "specimen_name": "All Specimens",
+        "gleason_score": "benign",
+        "gleason_pattern": "benign",
+        "num_cores": "No #C",
+        "percent_specimen": "unknown",
+        "features": {"HGPIN": 0, "ASAP": 0, "ATYP": 0, "INF": 0, "ADC": 0},
+        "comment": "benign"
+    }]
+
+def build_rows(content, accession_number, line_number, is_benign):
+    """
+    Validates one raw LLM response and turns it into output rows, along with whether the
+    response is worth caching (it validated and listed at least one specimen) and any warnings
+    for the caller to print. May run in a worker process, so it has to stay a top-level function.
+    """
+    messages = []
+    data = None
+    if content is not None:
+        try:
+            data = ExtractionResponse.model_validate_json(content).model_dump()
+        except ValidationError as e:
+            messages.append(f"Error validating JSON: {e}\nRaw Output:\n{content}")
 
-# Define file paths for input and output files
-input_csv_path = "input.csv"
-output_txt_path = "output.txt"
-
-try:
-    df_input = pd.read_csv(input_csv_path)
-except FileNotFoundError:
-    print(f"Error: The input file '{input_csv_path}' was not found.")
-    exit(1)
-except pd.errors.EmptyDataError:
-    print(f"Error: The input file '{input_csv_path}' is empty.")
-    exit(1)
-except pd.errors.ParserError:
-    print(f"Error: The input file '{input_csv_path}' could not be parsed correctly.")
-    exit(1)
-
-if "report" not in df_input.columns or "accession_number" not in df_input.columns:
-    print("Error: The input CSV must contain columns named 'report' and 'accession_number'.")
-    exit(1)
-
-extracted_data = []
-
-for index, row in df_input.iterrows():
-    report_text = row['report']
-    accession_number = row['accession_number']
-    line_number = index + 1
-    print(f"\nProcessing report {line_number} with accession number {accession_number}...")
-
-    number_of_specimens = get_number_of_specimens(report_text)
-    if number_of_specimens == 0:
-        print(f"⚠️ Warning: No specimens found for report {line_number}.")
-        number_of_specimens = 1  # Default to 1 to ensure at least one set of columns is created
-
-    extracted_specimens = extract_info_from_report(report_text, accession_number, number_of_specimens, line_number)
-
-    if extracted_specimens is None:
-        print(f"⚠️ Warning: No valid data extracted for report {line_number}.")
+    if data is not None and not data.get("number_of_specimens"):
+        messages.append(f"⚠️ Warning: No specimens found for report {line_number}.")
+
+    if data is None or not data["specimens"]:
+        messages.append(f"⚠️ Warning: No valid data extracted for report {line_number}.")
+        # Default to one specimen to ensure at least one set of columns is created
         extracted_specimens = [{
             "study_id": accession_number if accession_number else f"subject_{line_number}",
             "specimen_name": "Specimen Unknown",
@@ -175,40 +236,155 @@ for index, row in df_input.iterrows():
             "features": {"HGPIN": 0, "ASAP": 0, "ATYP": 0, "INF": 0, "ADC": 0},
             "comment": "No comment"
         }]
+    else:
+        extracted_specimens = data["specimens"]
+        for specimen in extracted_specimens:
+            specimen['study_id'] = accession_number if accession_number else f"subject_{line_number}"
 
-    for specimen in extracted_specimens:
-        if 'benign' in report_text.lower():
+    if is_benign:
+        for specimen in extracted_specimens:
             specimen['gleason_score'] = 'benign'
             specimen['gleason_pattern'] = 'benign'
             specimen['comment'] = 'benign'
 
-    extracted_data.extend(extracted_specimens)
-
-# Create a flattened data structure where each specimen is on its own line
-flattened_data = []
-columns = ["StudyID", "Specimen", "GS", "GP", "#C", "%Spec", "HGPIN", "ASAP", "ATYP", "INF", "ADC", "Comment"]
-
-for specimen in extracted_data:
-    row = [
-        specimen.get("study_id", ""),
-        specimen.get("specimen_name", ""),
-        specimen.get("gleason_score", ""),
-        specimen.get("gleason_pattern", ""),
-        specimen.get("num_cores", ""),
-        specimen.get("percent_specimen", "unknown"),
-        specimen.get("features", {}).get("HGPIN", 0),
-        specimen.get("features", {}).get("ASAP", 0),
-        specimen.get("features", {}).get("ATYP", 0),
-        specimen.get("features", {}).get("INF", 0),
-        specimen.get("features", {}).get("ADC", 0),
-        specimen.get("comment", "")
+    valid = data is not None and bool(data["specimens"])
+    return [specimen_row(specimen) for specimen in extracted_specimens], valid, messages
+
+async def fetch_batch(batch):
+    """
+    Sends a batch's LLM-bound reports to Ollama concurrently. Reports that skip the LLM get
+    (None, None) in place of a response and are filled from benign_template by the consumer.
+    """
+    for _, accession_number, line_number, skip, _ in batch:
+        if skip:
+            print(f"\nReport {line_number} with accession number {accession_number} is benign, skipping the LLM.")
+        else:
+            print(f"\nProcessing report {line_number} with accession number {accession_number}...")
+
+    contents = iter(await asyncio.gather(*(
+        fetch_response(report_text) for report_text, _, _, skip, _ in batch if not skip
+    )))
+    return [(None, None) if skip else next(contents) for _, _, _, skip, _ in batch]
+
+async def produce_responses(rows, queue):
+    """
+    Queries the LLM in batches of OLLAMA_NUM_PARALLEL concurrent requests and queues each
+    batch's raw responses and cache keys, followed by None once every report has been sent.
+    Reports that skip the LLM ride along in the batch they fall into so output keeps input order.
+    """
+    batch = []
+    llm_requests = 0
+    for row in rows:
+        batch.append(row)
+        if not row[3]:
+            llm_requests += 1
+        if llm_requests == OLLAMA_NUM_PARALLEL:
+            await queue.put((batch, await fetch_batch(batch)))
+            batch = []
+            llm_requests = 0
+    if batch:
+        await queue.put((batch, await fetch_batch(batch)))
+    await queue.put(None)
+
+async def consume_responses(queue, writer, use_pool):
+    """
+    Validates queued responses and writes the rows in input order. With use_pool, validation
+    runs in a process pool so it overlaps with the next batch's LLM requests; otherwise it runs
+    inline. Only responses that pass validation are cached, so a truncated or malformed reply
+    is requested again on the next run.
+    """
+    loop = asyncio.get_running_loop()
+    pool = ProcessPoolExecutor(max_workers=os.cpu_count()) if use_pool else None
+    try:
+        while (item := await queue.get()) is not None:
+            batch, responses = item
+            jobs = [
+                (content, accession_number, line_number, is_benign)
+                for (_, accession_number, line_number, skip, is_benign), (content, _) in zip(batch, responses) if not skip
+            ]
+            if pool is None:
+                built = iter([build_rows(*job) for job in jobs])
+            else:
+                built = iter(await asyncio.gather(*(loop.run_in_executor(pool, build_rows, *job) for job in jobs)))
+
+            for (_, accession_number, line_number, skip, _), (content, key) in zip(batch, responses):
+                if skip:
+                    writer.writerows(specimen_row(specimen) for specimen in benign_template(accession_number, line_number))
+                    continue
+                report_rows, valid, messages = next(built)
+                for message in messages:
+                    print(message)
+                if valid and key is not None:
+                    save_cached_response(key, content)
+                writer.writerows(report_rows)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+async def run_all(df_input, writer):
+    """
+    Runs every report through the LLM, or through benign_template when it skips the LLM,
+    and writes each batch's specimens in input order as soon as it has been validated.
+    """
+    # Classify the whole report column at once instead of scanning each report in Python
+    reports = df_input["report"].fillna("")
+    findings = reports.str.replace(_NEGATED, "", regex=True)
+    skip_llm = (reports.str.contains(_BENIGN) & ~findings.str.contains(_SUSPICIOUS)).to_numpy()
+    mentions_benign = (
+        reports.str.contains("benign", case=False, regex=False) & ~findings.str.contains(_CARCINOMA)
+    ).to_numpy()
+
+    rows = [
+        (report_text, accession_number, line_number, skip, is_benign)
+        for line_number, (report_text, accession_number, skip, is_benign) in enumerate(
+            zip(df_input["report"].to_numpy(), df_input["accession_number"].to_numpy(), skip_llm, mentions_benign),
+            start=1
+        )
     ]
-    flattened_data.append(row)
 
-# Write the flattened data to a text file
-with open(output_txt_path, "w") as f:
-    f.write(",".join(columns) + "\n")
-    for row in flattened_data:
-        f.write(",".join(map(str, row)) + "\n")
+    # A small queue keeps the LLM at most a couple of batches ahead of validation
+    queue = asyncio.Queue(maxsize=2)
+    use_pool = len(rows) >= PROCESS_POOL_MIN_ROWS
+    await asyncio.gather(produce_responses(rows, queue), consume_responses(queue, writer, use_pool))
+
+def main():
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "WARNING").upper())
+    # httpx logs every Ollama request at INFO; keep it quiet even under LOGLEVEL=DEBUG
+    logging.getLogger("httpx").setLevel(logging.WARNING)
 
-print(f"\n✅ Extraction complete. Data saved in: {output_txt_path}")
+    parser = argparse.ArgumentParser(description="Extract structured pathology data from reports with a local LLM.")
+    parser.add_argument("--no-cache", action="store_true", help="Query the LLM for every report instead of reusing cached responses; new responses still refresh the cache.")
+    args = parser.parse_args()
+
+    open_cache(reads=not args.no_cache)
+
+    # Define file paths for input and output files
+    input_csv_path = "input.csv"
+    output_txt_path = "output.txt"
+
+    try:
+        df_input = pd.read_csv(input_csv_path)
+    except FileNotFoundError:
+        print(f"Error: The input file '{input_csv_path}' was not found.")
+        exit(1)
+    except pd.errors.EmptyDataError:
+        print(f"Error: The input file '{input_csv_path}' is empty.")
+        exit(1)
+    except pd.errors.ParserError:
+        print(f"Error: The input file '{input_csv_path}' could not be parsed correctly.")
+        exit(1)
+
+    if "report" not in df_input.columns or "accession_number" not in df_input.columns:
+        print("Error: The input CSV must contain columns named 'report' and 'accession_number'.")
+        exit(1)
+
+    # Write one row per specimen to the text file as each batch finishes
+    with open(output_txt_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(OUTPUT_COLUMNS)
+        asyncio.run(run_all(df_input, writer))
+
+    print(f"\n✅ Extraction complete. Data saved in: {output_txt_path}")
+
+if __name__ == "__main__":
+    main()
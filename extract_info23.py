@@ -1,77 +1,57 @@
 import os
+import argparse
+import asyncio
+import hashlib
+import logging
+import sqlite3
 import pandas as pd
-import json
-import subprocess
-import re
+import orjson
+from concurrent.futures import ProcessPoolExecutor
+from ollama import AsyncClient
+from pydantic import BaseModel, ValidationError
+
+logger = logging.getLogger(__name__)
 
 # Define input and output file paths
 INPUT_CSV_PATH = "input.csv"
-OUTPUT_JSON_PATH = "output.json"
-MODEL_NAME = "medllama2"
-
-def clean_json_output(output):
-    """Clean markdown formatting from LLM output."""
-    output = output.strip()
-    # If output is wrapped in triple backticks, remove them.
-    if output.startswith("```"):
-        lines = output.splitlines()
-        # Remove the first line if it starts with ```
-        if lines[0].startswith("```"):
-            lines = lines[1:]
-        # Remove the last line if it ends with ```
-        if lines and lines[-1].startswith("```"):
-            lines = lines[:-1]
-        output = "\n".join(lines).strip()
-    return output
-
-def get_number_of_specimens(report_text):
-    """
-    Extracts the total number of biopsy specimens from the pathology report and their names.
-    """
-    prompt = f"""
-Extract the total number of biopsy specimens mentioned in the pathology report and list their names. The names may include the words (right, left, base, apex, mid, prostate, and biopsy).  It may also look like a numeric or alphabetic list. The name will end if a colon is present.
-Respond only with a JSON object in the following format:
-
-{{
-  "number_of_specimens": <integer>,
-  "specimen_names": keep only the first 4 words and nothing after a colon. Remove any commas between the words.
-}}
-
-Report:
-{report_text}
-"""
-    try:
-        result = subprocess.run(
-            ["ollama", "run", MODEL_NAME],
-            input=prompt,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            check=True
-        )
-        content = result.stdout.strip()
-        print("\nRaw LLM Output for number of specimens:\n", content)
-        content = clean_json_output(content)
-        data = json.loads(content)
-        return data.get("number_of_specimens", 1), data.get("specimen_names", [])
-    except Exception as e:
-        print(f"❌ Error extracting number of specimens: {e}")
-        return 1, []
+OUTPUT_JSON_PATH = "output.jsonl"
+MODEL_NAME = "medllama2:7b-q4_K_M"
+OLLAMA_HOST = "http://localhost:11434"
+# Keep the model loaded between requests
+KEEP_ALIVE = "30m"
+# Cap context and output length for the small JSON responses; a low temperature keeps the JSON well-formed
+OLLAMA_OPTIONS = {"num_ctx": 2048, "num_predict": 1024, "temperature": 0.1}
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "llmradiology", "responses.sqlite")
+# Keep in step with the server's OLLAMA_NUM_PARALLEL so each batch fills every slot
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
+# Below this many reports, validating inline is cheaper than starting worker processes
+PROCESS_POOL_MIN_ROWS = 10000
 
-def extract_info_from_report(report_text, accession_number, number_of_specimens, line_number):
-    """
-    Sends a pathology report to the local LLM via Ollama and extracts structured data for each specimen.
-    """
-    prompt = f"""
+# One async client keeps the connection to Ollama alive and lets requests overlap
+client = AsyncClient(host=OLLAMA_HOST)
+
+# In-memory and on-disk response caches; _cache_db stays None until open_cache is called,
+# and _cache_reads is False under --no-cache so responses are refreshed but not reused
+_response_memo = {}
+_cache_db = None
+_cache_reads = True
+
+# Fixed instructions sent as the system prompt. Keeping them identical for every report and placing
+# the report last lets Ollama reuse the cached prefix instead of re-processing it on each request.
+SYSTEM_PREFIX = """
 You are a data scientist tasked with extracting clinical data from a pathology report. Use only the data provided for a specific specimen name and do not infer data.
-Below is the pathology report:
-{report_text}
+The pathology report is given at the end.
+
+Extract the total number of biopsy specimens mentioned in the pathology report and list their names:
 
-Extract the following details for each of the {number_of_specimens} specimens:
+- "number_of_specimens": The total number of biopsy specimens as an integer.
+- "specimen_names": The name of each specimen. The names may include the words (right, left, base, apex, mid, prostate, and biopsy).  It may also look like a numeric or alphabetic list. The name will end if a colon is present. Keep only the first 4 words and nothing after a colon. Remove any commas between the words.
+
+Then extract the following details for each specimen in the "specimens" list:
 
 - "gleason_score": A numeric value from 6 to 10. If missing but "gleason_pattern" is present, sum the two patterns. If the specimen is benign, set to "benign". If no data is found, set to "unknown".
 - "gleason_pattern": A set of 2 numbers generally with a plus sign between them between 1-5 or a grade group with a value between 1 and 5. If the specimen is benign, set this value to "benign". If no data is found, set to "unknown".
-- "num_cores": Look for the number of biopsy cores named in the {report_text} and report the fraction of cancer containing cores over the total cores (e.g., "3/7"). If no data is found, set to "unknown".
+- "num_cores": Look for the number of biopsy cores named in the report and report the fraction of cancer containing cores over the total cores (e.g., "3/7"). If no data is found, set to "unknown".
 - "percent_specimen": Look for a number followed by (%) or the word (percentage) for the amount of cancer on the specimen (e.g., "<5%"). If a range is given, record the range. If no number with (%) or the word (percentage) is mentioned, set to "unknown".
 - "features": A dictionary containing:
     - "HGPIN": 0 (absent) or 1 (present).
@@ -87,14 +67,16 @@ Do not include any placeholder text from this prompt in your output. Only use da
 
 Respond **only** with a valid JSON object in the following format:
 
-{{
+{
+  "number_of_specimens": 0,
+  "specimen_names": [""],
   "specimens": [
-    {{
+    {
       "gleason_score": "",
       "gleason_pattern": "",
       "num_cores": "",
       "percent_specimen": "",
-      "features": {{
+      "features": {
         "HGPIN": 0,
         "ASAP": 0,
         "ATYP": 0,
@@ -102,40 +84,229 @@ Respond **only** with a valid JSON object in the following format:
         "ADC": 0,
         "PNI": 0,
         "Benign": 0
-      }},
+      },
       "comment": ""
-    }}
+    }
   ]
-}}
+}
 """
-    try:
-        result = subprocess.run(
-            ["ollama", "run", MODEL_NAME],
-            input=prompt,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            check=True
-        )
 
-        content = result.stdout.strip()
-        print("\nRaw LLM Output for specimen details:\n", content)
-        content = clean_json_output(content)
-        data = json.loads(content)
-
-        if isinstance(data, dict) and "specimens" in data and isinstance(data["specimens"], list):
-            return data["specimens"]
-        else:
-            print("⚠️ JSON missing 'specimens' key or not in expected format.")
-            return None
-    except json.JSONDecodeError:
-        print(f"❌ JSON Decode Error. Raw Output:\n{content}")
+# Response schema; Ollama constrains decoding to it and the reply is validated against it
+class Features(BaseModel):
+    HGPIN: int
+    ASAP: int
+    ATYP: int
+    INF: int
+    ADC: int
+    PNI: int
+    Benign: int
+
+class Specimen(BaseModel):
+    gleason_score: str
+    gleason_pattern: str
+    num_cores: str
+    percent_specimen: str
+    features: Features
+    comment: str
+
+class ExtractionResponse(BaseModel):
+    number_of_specimens: int
+    specimen_names: list[str]
+    specimens: list[Specimen]
+
+RESPONSE_SCHEMA = ExtractionResponse.model_json_schema()
+
+def open_cache(path=CACHE_PATH, reads=True):
+    """
+    Opens the on-disk response cache so reruns on unchanged reports skip the LLM.
+    With reads=False every report is sent to the LLM and the cache only receives the new responses.
+    """
+    global _cache_db, _cache_reads
+    _cache_reads = reads
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _cache_db = sqlite3.connect(path)
+    _cache_db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT NOT NULL)")
+
+def load_cached_response(key):
+    """
+    Returns the cached LLM response for the key, or None on a miss or when cache reads are disabled.
+    """
+    if _cache_db is None or not _cache_reads:
         return None
+    if key in _response_memo:
+        return _response_memo[key]
+    row = _cache_db.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+    if row is not None:
+        _response_memo[key] = row[0]
+        return row[0]
+    return None
+
+def save_cached_response(key, content):
+    """
+    Stores a validated LLM response in the memory and disk caches.
+    """
+    if _cache_db is None:
+        return
+    _response_memo[key] = content
+    with _cache_db:
+        _cache_db.execute("INSERT OR REPLACE INTO responses (key, content) VALUES (?, ?)", (key, content))
+
+def cache_key(prompt, system, schema):
+    """
+    Hashes everything that shapes a response, so editing the schema or the options misses old entries.
+    """
+    settings = orjson.dumps({"schema": schema, "options": OLLAMA_OPTIONS}, option=orjson.OPT_SORT_KEYS).decode()
+    return hashlib.sha256((MODEL_NAME + "\0" + settings + "\0" + system + "\0" + prompt).encode()).hexdigest()
+
+async def run_ollama(prompt, system, schema):
+    """
+    Sends a prompt to the local Ollama server and returns the raw response text, constrained
+    to the given JSON schema, with the cache key to save it under once it has been validated.
+    The key is None when the response already came from the cache.
+    """
+    key = cache_key(prompt, system, schema)
+    content = load_cached_response(key)
+    if content is not None:
+        return content, None
+
+    response = await client.generate(
+        model=MODEL_NAME,
+        prompt=prompt,
+        system=system,
+        format=schema,
+        options=OLLAMA_OPTIONS,
+        keep_alive=KEEP_ALIVE
+    )
+    content = response["response"].strip()
+    return content, key
+
+async def fetch_response(report_text):
+    """
+    Sends a pathology report to the local LLM via Ollama and returns the raw JSON text with the
+    number of specimens, their names and the details of each, plus its cache key, or (None, None)
+    if the request fails.
+    """
+    prompt = f"\n\n### Pathology Report:\n{report_text}\n"
+    try:
+        content, key = await run_ollama(prompt, SYSTEM_PREFIX, RESPONSE_SCHEMA)
     except Exception as e:
         print(f"❌ Unexpected error: {e}")
-        return None
+        return None, None
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Raw LLM Output for specimen details: %s", content)
+    return content, key
+
+def build_lines(content, accession_number, line_number):
+    """
+    Validates one raw LLM response and returns its specimens as JSON lines, along with whether the
+    response is worth caching (it validated and listed at least one specimen) and any warnings for
+    the caller to print. May run in a worker process, so it has to stay a top-level function.
+    """
+    messages = []
+    data = None
+    if content is not None:
+        try:
+            data = ExtractionResponse.model_validate_json(content).model_dump()
+        except ValidationError as e:
+            messages.append(f"❌ JSON Validation Error: {e}\nRaw Output:\n{content}")
+
+    if data is None:
+        messages.append(f"⚠️ No valid data extracted for report {line_number}. Adding default entry.")
+        extracted_specimens = [{
+            "study_id": accession_number,
+            "specimen_name": "Specimen Unknown",
+            "gleason_score": "unknown",
+            "gleason_pattern": "unknown",
+            "num_cores": "unknown",
+            "percent_specimen": "unknown",
+            "features": {"HGPIN": 0, "ASAP": 0, "ATYP": 0, "INF": 0, "ADC": 0, "PNI": 0, "Benign": 0},
+            "comment": "unknown"
+        }]
+    else:
+        specimen_names = data.get("specimen_names", [])
+        extracted_specimens = data["specimens"]
+        for i, specimen in enumerate(extracted_specimens):
+            specimen['study_id'] = accession_number
+            specimen['specimen_name'] = specimen_names[i] if i < len(specimen_names) else "Unknown Specimen"
+            specimen['comment'] = specimen['comment'][:200]
+
+    valid = data is not None and bool(data["specimens"])
+    return [orjson.dumps(specimen) + b"\n" for specimen in extracted_specimens], valid, messages
+
+async def produce_responses(rows, queue):
+    """
+    Queries the LLM in batches of OLLAMA_NUM_PARALLEL concurrent requests and queues each
+    batch's raw responses and cache keys, followed by None once every report has been sent.
+    """
+    for start in range(0, len(rows), OLLAMA_NUM_PARALLEL):
+        batch = rows[start:start + OLLAMA_NUM_PARALLEL]
+        for _, accession_number, line_number in batch:
+            print(f"\n🔍 Processing report {line_number} with accession number {accession_number}...")
+
+        # Extract the specimen names and pathology details
+        responses = await asyncio.gather(*(fetch_response(report_text) for report_text, _, _ in batch))
+        await queue.put((batch, responses))
+    await queue.put(None)
+
+async def consume_responses(queue, output_file, use_pool):
+    """
+    Validates queued responses and writes the lines in input order. With use_pool, validation
+    runs in a process pool while the next batch is with the LLM; otherwise it runs inline.
+    Only responses that pass validation are cached, so a truncated or malformed reply is
+    requested again on the next run.
+    """
+    loop = asyncio.get_running_loop()
+    pool = ProcessPoolExecutor(max_workers=os.cpu_count()) if use_pool else None
+    try:
+        while (item := await queue.get()) is not None:
+            batch, responses = item
+            jobs = [
+                (content, accession_number, line_number)
+                for (_, accession_number, line_number), (content, _) in zip(batch, responses)
+            ]
+            if pool is None:
+                batch_lines = [build_lines(*job) for job in jobs]
+            else:
+                batch_lines = await asyncio.gather(*(loop.run_in_executor(pool, build_lines, *job) for job in jobs))
+
+            for (content, key), (lines, valid, messages) in zip(responses, batch_lines):
+                for message in messages:
+                    print(message)
+                if valid and key is not None:
+                    save_cached_response(key, content)
+                output_file.writelines(lines)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+async def run_all(df_input, output_file):
+    """
+    Runs every report through the LLM and writes each specimen as a JSON line as soon as its
+    batch has been validated.
+    """
+    rows = [
+        (report_text, accession_number, line_number)
+        for line_number, (report_text, accession_number) in enumerate(
+            zip(df_input["report"].to_numpy(), df_input["accession_number"].to_numpy()), start=1
+        )
+    ]
+
+    # A small queue keeps the LLM at most a couple of batches ahead of validation
+    queue = asyncio.Queue(maxsize=2)
+    use_pool = len(rows) >= PROCESS_POOL_MIN_ROWS
+    await asyncio.gather(produce_responses(rows, queue), consume_responses(queue, output_file, use_pool))
 
 def main():
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "WARNING").upper())
+    # httpx logs every Ollama request at INFO; keep it quiet even under LOGLEVEL=DEBUG
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser(description="Extract structured pathology data from reports with a local LLM.")
+    parser.add_argument("--no-cache", action="store_true", help="Query the LLM for every report instead of reusing cached responses; new responses still refresh the cache.")
+    args = parser.parse_args()
+
+    open_cache(reads=not args.no_cache)
+
     # Load input CSV 
     try:
         df_input = pd.read_csv(INPUT_CSV_PATH)
@@ -154,43 +325,9 @@ def main():
         print("❌ Error: The input CSV must contain columns named 'report' and 'accession_number'.")
         return
 
-    extracted_data = []
-
-    # Process each report
-    for index, row in df_input.iterrows():
-        report_text = row['report']
-        accession_number = row['accession_number']
-        print(f"\n🔍 Processing report {index+1} with accession number {accession_number}...")
-
-        # Get number of specimens and their names
-        number_of_specimens, specimen_names = get_number_of_specimens(report_text)
-
-        # Extract pathology details
-        extracted_specimens = extract_info_from_report(report_text, accession_number, number_of_specimens, index+1)
-
-        if extracted_specimens is None:
-            print(f"⚠️ No valid data extracted for report {index+1}. Adding default entry.")
-            extracted_specimens = [{
-                "study_id": accession_number,
-                "specimen_name": "Specimen Unknown",
-                "gleason_score": "unknown",
-                "gleason_pattern": "unknown",
-                "num_cores": "unknown",
-                "percent_specimen": "unknown",
-                "features": {"HGPIN": 0, "ASAP": 0, "ATYP": 0, "INF": 0, "ADC": 0, "PNI": 0, "Benign": 0},
-                "comment": "unknown"
-            }]
-        else:
-            for i, specimen in enumerate(extracted_specimens):
-                specimen['study_id'] = accession_number
-                specimen['specimen_name'] = specimen_names[i] if i < len(specimen_names) else "Unknown Specimen"
-                specimen['comment'] = specimen['comment'][:200]
-
-        extracted_data.extend(extracted_specimens)
-
-    # Save output
-    with open(OUTPUT_JSON_PATH, "w") as f:
-        json.dump(extracted_data, f, indent=4)
+    # Save output one JSON line per specimen as each batch finishes
+    with open(OUTPUT_JSON_PATH, "wb") as output_file:
+        asyncio.run(run_all(df_input, output_file))
 
     print(f"\n✅ Extraction complete. Data saved in: {OUTPUT_JSON_PATH}")
 
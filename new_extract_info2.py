@@ -1,91 +1,116 @@
-import json
 import csv
+import argparse
+import asyncio
+import orjson
+from pathlib import Path
+from pydantic import BaseModel, ValidationError
 import openai  # Assuming OpenAI's API is being used for Mistral; update if using another LLM
 
 # Configure API Key (Ensure you set this up securely, do not hardcode in production)
 openai.api_key = "your_api_key_here"
 
+# Bounds the LLM requests in flight across all reports and extractors
+MAX_PARALLEL_REQUESTS = 8
+llm_slots = asyncio.Semaphore(MAX_PARALLEL_REQUESTS)
+
+# Fixed system message for extract_all; the fragment goes last in the user message so the
+# shared instructions form a reusable prefix
+EXTRACT_ALL_PREFIX = """
+You are a medical NLP model designed to extract structured pathology data.
+Extract the following details from the pathology report given at the end.
+Provide one JSON object with keys:
+- "gleason": An object with keys 'gleason_score' and 'gleason_pattern'. If benign, set score to 'benign'. If unknown, return 'unknown'.
+- "num_cores": The number of biopsy cores with cancer in the format 'X/Y' (cancer-containing cores/total cores). If unknown, return 'unknown'.
+- "percent_specimen": The percentage of cancer in the specimen. If unknown, return 'unknown'.
+- "features": An object with keys 'HGPIN', 'ASAP', 'ATYP', 'INF', 'ADC', 'PNI', 'Benign', each having a value of 0 (absent) or 1 (present).
+- "comment": The comment section. If no comment, return 'none'.
+"""
+
 # Function to call Mistral LLM with a structured prompt
-def call_mistral(prompt):
-    response = openai.ChatCompletion.create(
-        model="mistral-7b-instruct",
-        messages=[{"role": "system", "content": "You are a medical NLP model designed to extract structured pathology data."},
-                  {"role": "user", "content": prompt}],
-        temperature=0.3  # Lower temperature for more deterministic responses
-    )
+async def call_mistral(prompt, system):
+    async with llm_slots:
+        response = await openai.ChatCompletion.acreate(
+            model="mistral-7b-instruct",
+            messages=[{"role": "system", "content": system},
+                      {"role": "user", "content": prompt}],
+            temperature=0.3  # Lower temperature for more deterministic responses
+        )
     return response["choices"][0]["message"]["content"]
 
-# Hierarchical prompt structure
-def extract_gleason(report_text):
-    prompt = f"""
-    Extract the Gleason score and pattern from the following pathology report:
-    {report_text}
-    Provide JSON output with keys 'gleason_score' and 'gleason_pattern'. If benign, set score to 'benign'. If unknown, return 'unknown'.
-    """
-    return json.loads(call_mistral(prompt))
-
-def extract_cores(report_text):
-    prompt = f"""
-    Extract the number of biopsy cores with cancer from the following pathology report:
-    {report_text}
-    Provide JSON output with key 'num_cores' in the format 'X/Y' (cancer-containing cores/total cores). If unknown, return 'unknown'.
-    """
-    return json.loads(call_mistral(prompt))
-
-def extract_percent(report_text):
-    prompt = f"""
-    Extract the percentage of cancer in the specimen from the following pathology report:
-    {report_text}
-    Provide JSON output with key 'percent_specimen'. If unknown, return 'unknown'.
-    """
-    return json.loads(call_mistral(prompt))
-
-def extract_features(report_text):
-    prompt = f"""
-    Extract features from the pathology report:
-    {report_text}
-    Provide JSON output with keys: 'HGPIN', 'ASAP', 'ATYP', 'INF', 'ADC', 'PNI', 'Benign', each having a value of 0 (absent) or 1 (present).
-    """
-    return json.loads(call_mistral(prompt))
-
-def extract_comment(report_text):
-    prompt = f"""
-    Extract the comment section from the following pathology report:
-    {report_text}
-    Provide JSON output with key 'comment'. If no comment, return 'none'.
-    """
-    return json.loads(call_mistral(prompt))
-
-def process_report(report_text):
-    structured_data = {
-        "gleason": extract_gleason(report_text),
-        "num_cores": extract_cores(report_text),
-        "percent_specimen": extract_percent(report_text),
-        "features": extract_features(report_text),
-        "comment": extract_comment(report_text)
-    }
-    return structured_data
-
-# Read CSV and process each pathology report
-input_file = "input.csv"
-output_file = "output.json"
-data = []
-
-with open(input_file, newline='', encoding='utf-8') as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        report_id = row["accession_number"]
-        report_text = row["report"]
-        specimens = report_text.split("  ")  # Assuming specimens are separated by double spaces or similar
-        specimen_data = {"accession_number": report_id, "specimens": []}
-        
-        for specimen in specimens:
-            specimen_data["specimens"].append(process_report(specimen))
-        
-        data.append(specimen_data)
-
-# Write output JSON
-with open(output_file, "w", encoding='utf-8') as jsonfile:
-    json.dump(data, jsonfile, indent=4)
-
-print("Processing complete. Output saved to", output_file)
+# Response schema for extract_all, which asks for every field of a specimen in one call
+class Gleason(BaseModel):
+    gleason_score: str
+    gleason_pattern: str
+
+class Features(BaseModel):
+    HGPIN: int
+    ASAP: int
+    ATYP: int
+    INF: int
+    ADC: int
+    PNI: int
+    Benign: int
+
+class SpecimenData(BaseModel):
+    gleason: Gleason
+    num_cores: str
+    percent_specimen: str
+    features: Features
+    comment: str
+
+# Single prompt covering every specimen field
+async def extract_all(report_text):
+    prompt = f"\n\nReport:\n{report_text}\n"
+    content = await call_mistral(prompt, EXTRACT_ALL_PREFIX)
+    try:
+        return SpecimenData.model_validate_json(content).model_dump()
+    except ValidationError as e:
+        print(f"JSON Validation Error: {e}\nRaw Output:\n{content}")
+        return None
+
+# Extract each distinct fragment once; boilerplate fragments repeat across reports
+async def process_reports_deduplicated(fragment_lists):
+    distinct_fragments = list(dict.fromkeys(fragment for fragments in fragment_lists for fragment in fragments))
+    results = await asyncio.gather(*(extract_all(fragment) for fragment in distinct_fragments))
+    memo = dict(zip(distinct_fragments, results))
+    return [[memo[fragment] for fragment in fragments] for fragments in fragment_lists]
+
+# Process every report concurrently; llm_slots bounds how many requests reach the LLM at once
+async def run_all(fragment_lists, dedup):
+    if dedup:
+        return await process_reports_deduplicated(fragment_lists)
+    return await asyncio.gather(*(
+        asyncio.gather(*(extract_all(specimen) for specimen in specimens)) for specimens in fragment_lists
+    ))
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract structured pathology data from reports one specimen at a time.")
+    parser.add_argument("--dedup", action="store_true", help="Extract each distinct specimen fragment once and reuse the result for repeats.")
+    args = parser.parse_args()
+
+    input_file = "input.csv"
+    output_file = "output.json"
+
+    # Read CSV and split each pathology report into specimen fragments
+    reports = []
+    with open(input_file, newline='', encoding='utf-8') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            specimens = row["report"].split("  ")  # Assuming specimens are separated by double spaces or similar
+            reports.append((row["accession_number"], specimens))
+
+    fragment_lists = [specimens for _, specimens in reports]
+    results = asyncio.run(run_all(fragment_lists, args.dedup))
+
+    data = [
+        {"accession_number": report_id, "specimens": specimen_results}
+        for (report_id, _), specimen_results in zip(reports, results)
+    ]
+
+    # Write output JSON
+    Path(output_file).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+    print("Processing complete. Output saved to", output_file)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,73 @@
 import os
+import argparse
+import asyncio
+import csv
 import pandas as pd
 import json
-import subprocess
+import orjson
 import re
+from pathlib import Path
+from ollama import AsyncClient
+from pydantic import BaseModel, ValidationError
 
 # Define input and output file paths
 INPUT_CSV_PATH = "input.csv"
 OUTPUT_JSON_PATH = "output.json"
 MODEL_NAME = "mistral:7b-instruct-q4_K_M"
+OLLAMA_HOST = "http://localhost:11434"
+# Keep the model loaded between requests
+KEEP_ALIVE = "30m"
+# Keep in step with the server's OLLAMA_NUM_PARALLEL so requests fill every slot without queueing
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
+
+# One async client keeps the connection to Ollama alive and lets requests overlap
+client = AsyncClient(host=OLLAMA_HOST)
+# Bounds the LLM requests in flight across all reports and extractors
+llm_slots = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+
+# Fixed instructions sent as the system prompt. Keeping them identical for every report and placing
+# the report last lets Ollama reuse the cached prefix instead of re-processing it on each request.
+SPECIMEN_PREFIX = """
+Extract the total number of biopsy specimens mentioned in the pathology report and list their names. Then record all of the relevant text for 
+that specimen in a separate text field. The names may include the words (right, left, base, apex, mid, prostate, and biopsy).  It may also 
+look like a numeric or alphabetic list. The name will end if a colon is present. Remove any commas in the name and reorder the name if necessary
+ to begin with right or left, then vertical position, and then prostate biopsy. A valid response for a specimen name is right base prostate
+ biopsy. If you see right, left prostate biopsy, this means there are two biopsies for right and left and these should be separate specimens. 
+Below is an example response, do not infer answers.  If there is no specimen information, add "unknown" as the response. Respond only with a 
+JSON object in the format shown below.
+
+Example:
+{
+  "number_of_specimens": 2,
+  "specimen_names": ["right prostate biopsy", "left prostate biopsy"],
+  "specimen_text": ["ADENOCARCINOMA, GLEASON GRADE 3+3 = 6.  - IN ONE SMALL FOCUS (<5%).  - NO EXTRAPROSTATIC EXTENSION SEEN.  ", 
+  "GLANDULAR HYPERPLASIA."]
+}
+
+Format:
+{
+  "number_of_specimens": <integer>,
+  "specimen_names": [text, text],
+  "specimen_text": [text]
+}
+"""
+
+# Fixed instructions for extract_all, kept ahead of the fragment for the same prefix reuse
+EXTRACT_ALL_PREFIX = """
+Extract the following details from the pathology report given at the end.
+Provide one JSON object with keys:
+- "gleason": An object with keys 'gleason_score' and 'gleason_pattern'. If benign, set score to 'benign'. If unknown, return 'unknown'.
+- "num_cores": The number of biopsy cores with cancer in the format 'X/Y' (cancer-containing cores/total cores). If unknown, return 'unknown'.
+- "percent_specimen": The percentage of cancer in the specimen. If unknown, return 'unknown'.
+- "features": An object with keys:
+  - "HGPIN": 0 (absent) or 1 (present) - high grade prostatic intraepithelial neoplasia. If no data is found, set to 0.
+  - "ASAP": 0 (absent) or 1 (present) - atypical small acinar proliferation. If no data is found, set to 0.
+  - "ATYP": 0 (absent) or 1 (present) - any other mention of atypical glands besides ASAP specifically. If no data is found, set to 0.
+  - "INF": 0 (absent) or 1 (present) - inflammation or prostatitis. If no data is found, set to 0.
+  - "ADC": 0 (absent) or 1 (present) - adenocarcinoma described but no GS given. If no data is found, set to 0.
+  - "PNI": 0 (absent) or 1 (present) - perineural invasion. If no data is found, set to 0.
+- "comment": The comment section. If no comment, return 'none'.
+"""
 
 def clean_json_output(output):
     """Clean markdown formatting from LLM output."""
@@ -21,24 +81,19 @@ def clean_json_output(output):
         output = "\n".join(lines).strip()
     return output
 
-def run_ollama(prompt):
+async def run_ollama(prompt, system):
     """Runs the LLM and ensures JSON output."""
     try:
-        result = subprocess.run(
-            ["ollama", "run", MODEL_NAME],
-            input=prompt,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            check=True
-        )
-
-        # Handle errors if any
-        if result.stderr:
-            print(f"❌ LLM Error: {result.stderr.strip()}")
-            return None
-        
-        content = result.stdout.strip()
+        async with llm_slots:
+            response = await client.generate(
+                model=MODEL_NAME,
+                prompt=prompt,
+                system=system,
+                format="json",
+                keep_alive=KEEP_ALIVE
+            )
+
+        content = response["response"].strip()
         if not content:
             print("❌ Error: Empty response from LLM.")
             return None
@@ -47,8 +102,8 @@ def run_ollama(prompt):
 
         # Validate JSON output
         try:
-            return json.loads(content)
-        except json.JSONDecodeError:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
             print(f"❌ JSON Decode Error. Raw Output:\n{content}")
             return None
 
@@ -56,139 +111,115 @@ def run_ollama(prompt):
         print(f"❌ Unexpected error: {e}")
         return None
 
-def get_number_of_specimens(report_text):
+async def get_number_of_specimens(report_text):
     """Extracts the total number of biopsy specimens."""
-    prompt = f"""
-Extract the total number of biopsy specimens mentioned in the pathology report and list their names. Then record all of the relevant text for 
-that specimen in a separate text field. The names may include the words (right, left, base, apex, mid, prostate, and biopsy).  It may also 
-look like a numeric or alphabetic list. The name will end if a colon is present. Remove any commas in the name and reorder the name if necessary
- to begin with right or left, then vertical position, and then prostate biopsy. A valid response for a specimen name is right base prostate
- biopsy. If you see right, left prostate biopsy, this means there are two biopsies for right and left and these should be separate specimens. 
-Below is an example response, do not infer answers.  If there is no specimen information, add "unknown" as the response. Respond only with a 
-JSON object in the format shown below.
+    prompt = f"\n\nReport:\n{report_text}\n"
 
-Example:
-{{
-  "number_of_specimens": 2,
-  "specimen_names": ["right prostate biopsy", "left prostate biopsy"],
-  "specimen_text": ["ADENOCARCINOMA, GLEASON GRADE 3+3 = 6.  - IN ONE SMALL FOCUS (<5%).  - NO EXTRAPROSTATIC EXTENSION SEEN.  ", 
-  "GLANDULAR HYPERPLASIA."]
-}}
-
-Format:
-{{
-  "number_of_specimens": <integer>,
-  "specimen_names": [text, text],
-  "specimen_text": [text]
-}}
-
-Report:
-{report_text}
-"""
-
-    response = run_ollama(prompt)
+    response = await run_ollama(prompt, SPECIMEN_PREFIX)
     if response and isinstance(response, dict):
-        return response.get("number_of_specimens", 1), response.get("specimen_names", []), response.get(specimen_text, [])
+        return response.get("number_of_specimens", 1), response.get("specimen_names", []), response.get("specimen_text", [])
     else:
-        return 1, []
+        return 1, [], []
+
+async def split_report(report_text):
+    """Splits a report into specimen fragments, using the LLM's per-specimen text when it has any."""
+    _, _, specimen_text = await get_number_of_specimens(report_text)
+    # The model's list is unchecked JSON; keep only real text so fragments stay hashable for --dedup
+    fragments = []
+    if isinstance(specimen_text, list):
+        fragments = [
+            text for text in specimen_text
+            if isinstance(text, str) and text.strip() and text.strip().lower() != "unknown"
+        ]
+    if fragments:
+        return fragments
+    return report_text.split("  ")  # Assuming specimens are separated by double spaces or similar
 
 
 # Mock function to simulate the Mistral LLM processing locally
 def mock_mistral_processing(prompt):
-    # Add appropriate logic to handle the prompt and return a response
     # This is a placeholder function and should be replaced with actual logic
-    if "gleason" in prompt.lower():
-        return json.dumps({"gleason_score": "7", "gleason_pattern": "4+3"})
-    elif "number of biopsy cores" in prompt.lower():
-        return json.dumps({"num_cores": "3/10"})
-    elif "percentage of cancer" in prompt.lower():
-        return json.dumps({"percent_specimen": "30%"})
-    elif "features from the pathology report" in prompt.lower():
-        return json.dumps({"HGPIN": 0, "ASAP": 0, "ATYP": 0, "INF": 0, "ADC": 0, "PNI": 0, "Benign": 1})
-    elif "comment section" in prompt.lower():
-        return json.dumps({"comment": "No significant findings"})
-    else:
-        return json.dumps({"unknown": "unknown"})
-
-def call_mistral(prompt):
-    return mock_mistral_processing(prompt)
-
-def extract_gleason(report_text):
-    prompt = f"""
-    Extract the Gleason score and pattern from the following pathology report:
-    {report_text}
-    Provide JSON output with keys 'gleason_score' and 'gleason_pattern'. If benign, set score to 'benign'. If unknown, return 'unknown'.
-    """
-    return json.loads(call_mistral(prompt))
-
-def extract_cores(report_text):
-    prompt = f"""
-    Extract the number of biopsy cores with cancer from the following pathology report:
-    {report_text}
-    Provide JSON output with key 'num_cores' in the format 'X/Y' (cancer-containing cores/total cores). If unknown, return 'unknown'.
-    """
-    return json.loads(call_mistral(prompt))
-
-def extract_percent(report_text):
-    prompt = f"""
-    Extract the percentage of cancer in the specimen from the following pathology report:
-    {report_text}
-    Provide JSON output with key 'percent_specimen'. If unknown, return 'unknown'.
-    """
-    return json.loads(call_mistral(prompt))
-
-def extract_features(report_text):
-    prompt = f"""
-    Extract features from the pathology report:
-    {report_text}
-    Provide JSON output with keys: 
-  - "HGPIN": 0 (absent) or 1 (present) - high grade prostatic intraepithelial neoplasia. If no data is found, set to 0.
-  - "ASAP": 0 (absent) or 1 (present) - atypical small acinar proliferation. If no data is found, set to 0.
-  - "ATYP": 0 (absent) or 1 (present) - any other mention of atypical glands besides ASAP specifically. If no data is found, set to 0.
-  - "INF": 0 (absent) or 1 (present) - inflammation or prostatitis. If no data is found, set to 0.
-  - "ADC": 0 (absent) or 1 (present) - adenocarcinoma described but no GS given. If no data is found, set to 0.
-  - "PNI": 0 (absent) or 1 (present) - perineural invasion. If no data is found, set to 0.
-    """
-    return json.loads(call_mistral(prompt))
-
-def extract_comment(report_text):
-    prompt = f"""
-    Extract the comment section from the following pathology report:
-    {report_text}
-    Provide JSON output with key 'comment'. If no comment, return 'none'.
-    """
-    return json.loads(call_mistral(prompt))
-
-def process_report(report_text):
-    structured_data = {
-        "gleason": extract_gleason(report_text),
-        "num_cores": extract_cores(report_text),
-        "percent_specimen": extract_percent(report_text),
-        "features": extract_features(report_text),
-        "comment": extract_comment(report_text)
-    }
-    return structured_data
-
-# Read CSV and process each pathology report
-input_file = "input.csv"
-output_file = "output.json"
-data = []
-
-with open(input_file, newline='', encoding='utf-8') as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        report_id = row["accession_number"]
-        report_text = row["report"]
-        specimens = report_text.split("  ")  # Assuming specimens are separated by double spaces or similar
-        specimen_data = {"accession_number": report_id, "specimens": []}
-        
-        for specimen in specimens:
-            specimen_data["specimens"].append(process_report(specimen))
-        
-        data.append(specimen_data)
-
-# Write output JSON
-with open(output_file, "w", encoding='utf-8') as jsonfile:
-    json.dump(data, jsonfile, indent=4)
-
-print("Processing complete. Output saved to", output_file)
\ No newline at end of file
+    return json.dumps({
+        "gleason": {"gleason_score": "7", "gleason_pattern": "4+3"},
+        "num_cores": "3/10",
+        "percent_specimen": "30%",
+        "features": {"HGPIN": 0, "ASAP": 0, "ATYP": 0, "INF": 0, "ADC": 0, "PNI": 0},
+        "comment": "No significant findings"
+    })
+
+async def call_mistral(prompt, system):
+    async with llm_slots:
+        return mock_mistral_processing(system + prompt)
+
+# Response schema for extract_all, which asks for every field of a specimen in one call
+class Gleason(BaseModel):
+    gleason_score: str
+    gleason_pattern: str
+
+class Features(BaseModel):
+    HGPIN: int
+    ASAP: int
+    ATYP: int
+    INF: int
+    ADC: int
+    PNI: int
+
+class SpecimenData(BaseModel):
+    gleason: Gleason
+    num_cores: str
+    percent_specimen: str
+    features: Features
+    comment: str
+
+async def extract_all(report_text):
+    prompt = f"\n\nReport:\n{report_text}\n"
+    content = await call_mistral(prompt, EXTRACT_ALL_PREFIX)
+    try:
+        return SpecimenData.model_validate_json(content).model_dump()
+    except ValidationError as e:
+        print(f"❌ JSON Validation Error: {e}\nRaw Output:\n{content}")
+        return None
+
+# Extract each distinct fragment once; boilerplate fragments repeat across reports
+async def process_reports_deduplicated(fragment_lists):
+    distinct_fragments = list(dict.fromkeys(fragment for fragments in fragment_lists for fragment in fragments))
+    results = await asyncio.gather(*(extract_all(fragment) for fragment in distinct_fragments))
+    memo = dict(zip(distinct_fragments, results))
+    return [[memo[fragment] for fragment in fragments] for fragments in fragment_lists]
+
+# Process every report concurrently; llm_slots bounds how many requests reach the LLM at once
+async def run_all(report_texts, dedup):
+    fragment_lists = await asyncio.gather(*(split_report(report_text) for report_text in report_texts))
+    if dedup:
+        return await process_reports_deduplicated(fragment_lists)
+    return await asyncio.gather(*(
+        asyncio.gather(*(extract_all(specimen) for specimen in specimens)) for specimens in fragment_lists
+    ))
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract structured pathology data from reports one specimen at a time.")
+    parser.add_argument("--dedup", action="store_true", help="Extract each distinct specimen fragment once and reuse the result for repeats.")
+    args = parser.parse_args()
+
+    # Read CSV; run_all splits each pathology report into specimen fragments
+    reports = []
+    with open(INPUT_CSV_PATH, newline='', encoding='utf-8') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            reports.append((row["accession_number"], row["report"]))
+
+    report_texts = [report_text for _, report_text in reports]
+    results = asyncio.run(run_all(report_texts, args.dedup))
+
+    data = [
+        {"accession_number": report_id, "specimens": specimen_results}
+        for (report_id, _), specimen_results in zip(reports, results)
+    ]
+
+    # Write output JSON
+    Path(OUTPUT_JSON_PATH).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+    print("Processing complete. Output saved to", OUTPUT_JSON_PATH)
+
+if __name__ == "__main__":
+    main()